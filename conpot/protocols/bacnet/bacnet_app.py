@@ -19,13 +19,13 @@
 # Brno University of Technology, Faculty of Information Technology
 
 import logging
-import re
 import sys
-from bacpypes.pdu import GlobalBroadcast
+from bacpypes.pdu import Address, GlobalBroadcast
 import bacpypes.object
 from bacpypes.app import BIPSimpleApplication
 from bacpypes.constructeddata import Any
 from bacpypes.constructeddata import InvalidParameterDatatype
+from bacpypes.errors import DecodingError
 from bacpypes.apdu import (
     APDU,
     apdu_types,
@@ -44,6 +44,24 @@ import ast
 
 logger = logging.getLogger(__name__)
 
+# translation table used to normalize template object types into BACnet object classes
+_OBJTYPE_SPACE = str.maketrans("-", " ")
+
+# PDU types that never get a reply, 0x8 - 0xF are reserved
+_IGNORED_PDU_TYPES = frozenset(range(0x2, 0x10))
+
+# errors raised while decoding a confirmed service request
+_DECODE_ERRORS = (AttributeError, RuntimeError, InvalidParameterDatatype)
+
+# destination of I-Am and I-Have replies, never modified once created
+_GLOBAL_BROADCAST = GlobalBroadcast()
+
+
+def _to_camel(tag):
+    """convert a template tag such as max_apdu_length_accepted to maxApduLengthAccepted"""
+    parts = tag.replace("-", "_").split("_")
+    return parts[0].lower() + "".join(part.title() for part in parts[1:])
+
 
 class BACnetApp(BIPSimpleApplication):
     """
@@ -56,67 +74,82 @@ class BACnetApp(BIPSimpleApplication):
     """
 
     def __init__(self, device, datagram_server):
-        self._request = None
-        self._response = None
-        self._response_service = None
         self.localDevice = device
         self.objectName = {device.objectName: device}
         self.objectIdentifier = {device.objectIdentifier: device}
+        self._device_instance = device.objectIdentifier[1]
+        self.objectProperties = {}
         self.datagram_server = datagram_server
         self.deviceIdentifier = None
+        self._iam_response = None
+        self._iam_data = None
         super(BIPSimpleApplication, self).__init__()
+        # map service choices to their handlers (None for services we don't implement)
+        self._confirmed_handlers = {
+            value: getattr(self, key, None)
+            for key, value in ConfirmedServiceChoice.enumerations.items()
+        }
+        self._unconfirmed_handlers = {
+            value: getattr(self, key, None)
+            for key, value in UnconfirmedServiceChoice.enumerations.items()
+        }
 
     def get_objects_and_properties(self, dom):
         """
         parse the bacnet template for objects and their properties
         """
-        self.deviceIdentifier = int(dom.xpath("//bacnet/device_info/*")[1].text)
         device_property_list = dom.xpath("//bacnet/device_info/*")
+        self.deviceIdentifier = int(device_property_list[1].text)
         for prop in device_property_list:
-            prop_key = prop.tag.lower().title()
-            prop_key = re.sub("['_','-']", "", prop_key)
-            prop_key = prop_key[0].lower() + prop_key[1:]
+            prop_key = _to_camel(prop.tag)
             if (
                 prop_key not in self.localDevice.propertyList.value
                 and prop_key not in ["deviceIdentifier", "deviceName"]
             ):
                 self.add_property(prop_key, prop.text)
 
-        object_list = dom.xpath("//bacnet/object_list/object/@name")
+        object_list = dom.xpath("//bacnet/object_list/object")
         for obj in object_list:
-            property_list = dom.xpath(
-                '//bacnet/object_list/object[@name="%s"]/properties/*' % obj
-            )
+            property_list = obj.findall("properties/*")
             for prop in property_list:
                 if prop.tag == "object_type":
-                    object_type = re.sub("-", " ", prop.text).lower().title()
-                    object_type = re.sub(" ", "", object_type) + "Object"
+                    object_type = prop.text.translate(_OBJTYPE_SPACE).lower().title()
+                    object_type = object_type.replace(" ", "") + "Object"
             try:
                 device_object = getattr(bacpypes.object, object_type)()
-                device_object.propertyList = list()
             except NameError:
                 logger.critical("Non-existent BACnet object type")
                 sys.exit(3)
+            # property names are collected locally, every propertyList access goes through ReadProperty
+            property_names = list()
             for prop in property_list:
-                prop_key = prop.tag.lower().title()
-                prop_key = re.sub("['_','-']", "", prop_key)
-                prop_key = prop_key[0].lower() + prop_key[1:]
-                if prop_key == "objectType":
-                    prop_val = prop.text.lower().title()
-                    prop_val = re.sub(" ", "", prop_val)
-                    prop_val = prop_val[0].lower() + prop_val[1:]
+                prop_key = _to_camel(prop.tag)
                 prop_val = prop.text
                 try:
                     if prop_key == "objectIdentifier":
                         device_object.objectIdentifier = int(prop_val)
                     else:
                         setattr(device_object, prop_key, prop_val)
-                        device_object.propertyList.append(prop_key)
+                        property_names.append(prop_key)
                 except bacpypes.object.PropertyError:
                     logger.critical("Non-existent BACnet property type")
                     sys.exit(3)
+            device_object.propertyList = property_names
             self.add_object(device_object)
 
+        # the I-Am reply never changes, so build and encode it only once
+        self._iam_response = IAmRequest()
+        self._iam_response.pduDestination = _GLOBAL_BROADCAST
+        self._iam_response.iAmDeviceIdentifier = self.deviceIdentifier
+        self._iam_response.maxAPDULengthAccepted = int(
+            self.localDevice.maxApduLengthAccepted
+        )
+        self._iam_response.segmentationSupported = (
+            self.localDevice.segmentationSupported
+        )
+        self._iam_response.vendorID = int(self.localDevice.vendorIdentifier)
+        self._iam_data = self._encode(self._iam_response)
+
     def add_object(self, obj):
         object_name = obj.objectName
         if not object_name:
@@ -133,6 +166,21 @@ class BACnetApp(BIPSimpleApplication):
         self.objectName[object_name] = obj
         self.objectIdentifier[object_identifier] = obj
         self.localDevice.objectList.append(object_identifier)
+        # properties readable through ReadProperty, keyed by property identifier
+        self.objectProperties[object_identifier] = {
+            prop.identifier: prop for prop in obj.properties
+        }
+
+    def get_object(self, object_identifier):
+        """
+        look up a template object by its (type, instance) identifier, the device itself is excluded
+        """
+        obj = self.objectIdentifier.get(
+            (object_identifier[0], int(object_identifier[1]))
+        )
+        if obj is self.localDevice:
+            return None
+        return obj
 
     def add_property(self, prop_name, prop_value):
         if not prop_name:
@@ -144,12 +192,10 @@ class BACnetApp(BIPSimpleApplication):
         self.localDevice.propertyList.append(prop_name)
 
     def iAm(self, *args):
-        self._response = None
-        return
+        return None
 
     def iHave(self, *args):
-        self._response = None
-        return
+        return None
 
     def whoIs(self, request, address, invoke_key, device):
         # Limits are optional (but if used, must be paired)
@@ -158,12 +204,12 @@ class BACnetApp(BIPSimpleApplication):
             if (request.deviceInstanceRangeLowLimit is not None) and (
                 request.deviceInstanceRangeHighLimit is not None
             ):
-                if (
+                if not (
                     request.deviceInstanceRangeLowLimit
-                    > list(self.objectIdentifier.keys())[0][1]
-                    > request.deviceInstanceRangeHighLimit
+                    <= self._device_instance
+                    <= request.deviceInstanceRangeHighLimit
                 ):
-                    logger.info("Bacnet WhoHasRequest out of range")
+                    logger.info("Bacnet WhoIsRequest out of range")
                 else:
                     execute = True
             else:
@@ -172,244 +218,199 @@ class BACnetApp(BIPSimpleApplication):
             execute = True
 
         if execute:
-            self._response_service = "IAmRequest"
-            self._response = IAmRequest()
-            self._response.pduDestination = GlobalBroadcast()
-            self._response.iAmDeviceIdentifier = self.deviceIdentifier
-            # self._response.objectIdentifier = list(self.objectIdentifier.keys())[0][1]
-            self._response.maxAPDULengthAccepted = int(
-                getattr(self.localDevice, "maxApduLengthAccepted")
-            )
-            self._response.segmentationSupported = getattr(
-                self.localDevice, "segmentationSupported"
-            )
-            self._response.vendorID = int(getattr(self.localDevice, "vendorIdentifier"))
+            return self._iam_response, "IAmRequest"
+        return None
 
     def whoHas(self, request, address, invoke_key, device):
-        execute = False
-        try:
-            if (request.deviceInstanceRangeLowLimit is not None) and (
-                request.deviceInstanceRangeHighLimit is not None
-            ):
-                if (
-                    request.deviceInstanceRangeLowLimit
-                    > list(self.objectIdentifier.keys())[0][1]
-                    > request.deviceInstanceRangeHighLimit
-                ):
-                    logger.info("Bacnet WhoHasRequest out of range")
-                else:
-                    execute = True
-            else:
-                execute = True
-        except AttributeError:
-            execute = True
+        # Limits are optional, Who-Has carries them in a separate limits sequence
+        execute = True
+        limits = request.limits
+        if limits is not None and not (
+            limits.deviceInstanceRangeLowLimit
+            <= self._device_instance
+            <= limits.deviceInstanceRangeHighLimit
+        ):
+            logger.info("Bacnet WhoHasRequest out of range")
+            execute = False
 
         if execute:
-            for obj in device.objectList.value[2:]:
-                if (
-                    int(request.object.objectIdentifier[1]) == obj[1]
-                    and request.object.objectIdentifier[0] == obj[0]
-                ):
-                    objName = self.objectIdentifier[obj].objectName
-                    self._response_service = "IHaveRequest"
-                    self._response = IHaveRequest()
-                    self._response.pduDestination = GlobalBroadcast()
-                    # self._response.deviceIdentifier = list(self.objectIdentifier.keys())[0][1]
-                    self._response.deviceIdentifier = self.deviceIdentifier
-                    self._response.objectIdentifier = obj[1]
-                    self._response.objectName = objName
-                    break
-            else:
-                logger.info("Bacnet WhoHasRequest: no object found")
+            obj = self.get_object(request.object.objectIdentifier)
+            if obj is not None:
+                response = IHaveRequest()
+                response.pduDestination = _GLOBAL_BROADCAST
+                response.deviceIdentifier = self.deviceIdentifier
+                response.objectIdentifier = obj.objectIdentifier[1]
+                response.objectName = obj.objectName
+                return response, "IHaveRequest"
+            logger.info("Bacnet WhoHasRequest: no object found")
+        return None
 
     def readProperty(self, request, address, invoke_key, device):
         # Read Property
         # TODO: add support for PropertyArrayIndex handling;
-        for obj in device.objectList.value[2:]:
-            if (
-                int(request.objectIdentifier[1]) == obj[1]
-                and request.objectIdentifier[0] == obj[0]
-            ):
-                objName = self.objectIdentifier[obj].objectName
-                for prop in self.objectIdentifier[obj].properties:
-                    if request.propertyIdentifier == prop.identifier:
-                        propName = prop.identifier
-                        propValue = prop.ReadProperty(self.objectIdentifier[obj])
-                        propType = prop.datatype()
-                        self._response_service = "ComplexAckPDU"
-                        self._response = ReadPropertyACK()
-                        self._response.pduDestination = address
-                        self._response.apduInvokeID = invoke_key
-                        self._response.objectIdentifier = obj[1]
-                        self._response.objectName = objName
-                        self._response.propertyIdentifier = propName
-
-                        # get the property type
-                        for p in dir(sys.modules[propType.__module__]):
-                            _obj = getattr(sys.modules[propType.__module__], p)
-                            try:
-                                if type(propType) == _obj:
-                                    break
-                            except TypeError:
-                                pass
-                        value = ast.literal_eval(propValue)
-                        self._response.propertyValue = Any(_obj(value))
-                        # self._response.propertyValue.cast_in(objPropVal)
-                        # self._response.debug_contents()
-                        break
-                else:
-                    logger.info(
-                        "Bacnet ReadProperty: object has no property %s",
-                        request.propertyIdentifier,
-                    )
-                    self._response = ErrorPDU()
-                    self._response.pduDestination = address
-                    self._response.apduInvokeID = invoke_key
-                    self._response.apduService = 0x0C
-                    # self._response.errorClass
-                    # self._response.errorCode
+        obj = self.get_object(request.objectIdentifier)
+        if obj is not None:
+            objName = obj.objectName
+            prop = self.objectProperties[obj.objectIdentifier].get(
+                request.propertyIdentifier
+            )
+            if prop is not None:
+                propName = prop.identifier
+                propValue = prop.ReadProperty(obj)
+                propType = prop.datatype
+                response = ReadPropertyACK()
+                response.pduDestination = address
+                response.apduInvokeID = invoke_key
+                response.objectIdentifier = obj.objectIdentifier[1]
+                response.objectName = objName
+                response.propertyIdentifier = propName
+
+                value = ast.literal_eval(propValue)
+                response.propertyValue = Any(propType(value))
+                # response.propertyValue.cast_in(objPropVal)
+                # response.debug_contents()
+                return response, "ComplexAckPDU"
+            logger.info(
+                "Bacnet ReadProperty: object has no property %s",
+                request.propertyIdentifier,
+            )
+            response = ErrorPDU()
+            response.pduDestination = address
+            response.apduInvokeID = invoke_key
+            response.apduService = 0x0C
+            # response.errorClass
+            # response.errorCode
+            return response, "ErrorPDU"
+        return None
 
     def indication(self, apdu, address, device):
-        """logging the received PDU type and Service request"""
+        """
+        logging the received PDU type and Service request, returns a (response APDU, service name) tuple
+        or None when the request gets no reply
+        """
+        if apdu.apduType in _IGNORED_PDU_TYPES:
+            # simple ack, complex ack, segment ack, error, reject, abort and reserved PDUs
+            return None
         request = None
-        apdu_type = apdu_types.get(apdu.apduType)
         invoke_key = apdu.apduInvokeID
-        logger.info(
-            "Bacnet PDU received from %s:%d. (%s)",
-            address[0],
-            address[1],
-            apdu_type.__name__,
-        )
-        if apdu_type.pduType == 0x0:
-            # Confirmed request handling
-            apdu_service = confirmed_request_types.get(apdu.apduService)
+        # skip building the log arguments when nobody listens
+        log_info = logger.isEnabledFor(logging.INFO)
+        if log_info:
             logger.info(
-                "Bacnet indication from %s:%d. (%s)",
+                "Bacnet PDU received from %s:%d. (%s)",
                 address[0],
                 address[1],
-                apdu_service.__name__,
+                apdu_types.get(apdu.apduType).__name__,
             )
+        pdu_type = apdu.apduType
+        if pdu_type == 0x0:
+            # Confirmed request handling
+            apdu_service = confirmed_request_types.get(apdu.apduService)
+            if log_info:
+                logger.info(
+                    "Bacnet indication from %s:%d. (%s)",
+                    address[0],
+                    address[1],
+                    apdu_service.__name__,
+                )
             try:
                 request = apdu_service()
                 request.decode(apdu)
-            except (AttributeError, RuntimeError, InvalidParameterDatatype) as e:
-                logger.warning("Bacnet indication: Invalid service. Error: %s" % e)
-                return
-            except bacpypes.errors.DecodingError:
+            except _DECODE_ERRORS as e:
+                logger.warning("Bacnet indication: Invalid service. Error: %s", e)
+                return None
+            except DecodingError:
                 pass
 
-            for key, value in list(ConfirmedServiceChoice.enumerations.items()):
-                if apdu_service.serviceChoice == value:
-                    try:
-                        getattr(self, key)(request, address, invoke_key, device)
-                        break
-                    except AttributeError:
-                        logger.error("Not implemented Bacnet command")
-                        self._response = None
-                        return
-            else:
+            if apdu_service.serviceChoice not in self._confirmed_handlers:
                 logger.info(
                     "Bacnet indication: Invalid confirmed service choice (%s)",
                     apdu_service.__name__,
                 )
-                self._response = None
-                return
+                return None
+            handler = self._confirmed_handlers.get(apdu_service.serviceChoice)
+            if handler is None:
+                logger.error("Not implemented Bacnet command")
+                return None
+            try:
+                return handler(request, address, invoke_key, device)
+            except AttributeError:
+                logger.error("Not implemented Bacnet command")
+                return None
 
         # Unconfirmed request handling
-        elif apdu_type.pduType == 0x1:
+        elif pdu_type == 0x1:
             apdu_service = unconfirmed_request_types.get(apdu.apduService)
-            logger.info(
-                "Bacnet indication from %s:%d. (%s)",
-                address[0],
-                address[1],
-                apdu_service.__name__,
-            )
+            if log_info:
+                logger.info(
+                    "Bacnet indication from %s:%d. (%s)",
+                    address[0],
+                    address[1],
+                    apdu_service.__name__,
+                )
             try:
                 request = apdu_service()
                 request.decode(apdu)
             except (AttributeError, RuntimeError):
                 logger.exception("Bacnet indication: Invalid service.")
-                self._response = None
-                return
-            except bacpypes.errors.DecodingError:
+                return None
+            except DecodingError:
                 pass
 
-            for key, value in list(UnconfirmedServiceChoice.enumerations.items()):
-                if apdu_service.serviceChoice == value:
-                    try:
-                        getattr(self, key)(request, address, invoke_key, device)
-                        break
-                    except AttributeError:
-                        logger.error("Not implemented Bacnet command")
-                        self._response = None
-                        return
-            else:
+            if apdu_service.serviceChoice not in self._unconfirmed_handlers:
                 # Unrecognized services
                 logger.info(
                     "Bacnet indication: Invalid unconfirmed service choice (%s)",
                     apdu_service,
                 )
-                self._response_service = "ErrorPDU"
-                self._response = ErrorPDU()
-                self._response.pduDestination = address
-                return
-        # ignore the following
-        elif apdu_type.pduType == 0x2:
-            # simple ack pdu
-            self._response = None
-            return
-        elif apdu_type.pduType == 0x3:
-            # complex ack pdu
-            self._response = None
-            return
-        elif apdu_type.pduType == 0x4:
-            # segment ack
-            self._response = None
-            return
-        elif apdu_type.pduType == 0x5:
-            # error pdu
-            self._response = None
-            return
-        elif apdu_type.pduType == 0x6:
-            # reject pdu
-            self._response = None
-            return
-        elif apdu_type.pduType == 0x7:
-            # abort pdu
-            self._response = None
-            return
-        elif 0x8 <= apdu_type.pduType <= 0xF:
-            # reserved
-            self._response = None
-            return
+                response = ErrorPDU()
+                response.pduDestination = address
+                return response, "ErrorPDU"
+            handler = self._unconfirmed_handlers.get(apdu_service.serviceChoice)
+            if handler is None:
+                logger.error("Not implemented Bacnet command")
+                return None
+            try:
+                return handler(request, address, invoke_key, device)
+            except AttributeError:
+                logger.error("Not implemented Bacnet command")
+                return None
         else:
             # non-BACnet PDU types
             logger.info("Bacnet Unrecognized service")
-            self._response = None
-            return
+            return None
 
-    # socket not actually socket, but DatagramServer with sendto method
-    def response(self, response_apdu, address):
-        if response_apdu is None:
-            return
+    @staticmethod
+    def _encode(response_apdu):
         apdu = APDU()
         response_apdu.encode(apdu)
         pdu = PDU()
         apdu.encode(pdu)
-        if isinstance(response_apdu, RejectPDU) or isinstance(response_apdu, ErrorPDU):
-            self.datagram_server.sendto(pdu.pduData, address)
+        return pdu.pduData
+
+    # socket not actually socket, but DatagramServer with sendto method
+    def response(self, response_apdu, response_service, address):
+        if response_apdu is None:
+            return
+        if response_apdu is self._iam_response:
+            pdu_data = self._iam_data
         else:
+            pdu_data = self._encode(response_apdu)
+        error = isinstance(response_apdu, (RejectPDU, ErrorPDU))
+        # requests are answered with a (host, port) tuple, I-Am/I-Have with a GlobalBroadcast
+        destination_type = getattr(response_apdu.pduDestination, "addrType", None)
+        if not error and destination_type == Address.globalBroadcastAddr:
+            # broadcast
+            destination = ("", address[1])
+        else:
+            destination = address
+        # sendto operates under lock
+        self.datagram_server.sendto(pdu_data, destination)
+        if not error and logger.isEnabledFor(logging.INFO):
             apdu_type = apdu_types.get(response_apdu.apduType)
-            if pdu.pduDestination == "*:*":
-                # broadcast
-                # sendto operates under lock
-                self.datagram_server.sendto(pdu.pduData, ("", address[1]))
-            else:
-                # sendto operates under lock
-                self.datagram_server.sendto(pdu.pduData, address)
             logger.info(
                 "Bacnet response sent to %s (%s:%s)",
                 response_apdu.pduDestination,
                 apdu_type.__name__,
-                self._response_service,
+                response_service,
             )
@@ -81,9 +81,10 @@ class BacnetServer(object):
             except DecodingError:
                 logger.warning("DecodingError - PDU: {}".format(pdu))
                 return
-            self.bacnet_app.indication(apdu, address, self.thisDevice)
+            response = self.bacnet_app.indication(apdu, address, self.thisDevice)
             # send an appropriate response from BACnet app to the attacker
-            self.bacnet_app.response(self.bacnet_app._response, address)
+            if response is not None:
+                self.bacnet_app.response(*response, address)
         logger.info(
             "Bacnet client disconnected %s:%d. (%s)", address[0], address[1], session.id
         )
@@ -17,10 +17,12 @@
 
 from gevent import monkey
 
-monkey.patch_all()
+# other test modules collected in the same session may already have patched the stdlib
+if not monkey.is_module_patched("socket"):
+    monkey.patch_all()
 
 import unittest
-from gevent import socket, Timeout
+from gevent import socket, select
 
 from bacpypes.pdu import GlobalBroadcast, PDU
 from bacpypes.apdu import (
@@ -29,6 +31,7 @@ from bacpypes.apdu import (
     IAmRequest,
     IHaveRequest,
     WhoHasObject,
+    WhoHasLimits,
     WhoHasRequest,
     ReadPropertyRequest,
     ReadPropertyACK,
@@ -39,6 +42,40 @@ from bacpypes.primitivedata import Real
 from conpot.protocols.bacnet import bacnet_server
 from conpot.utils.greenlet import spawn_test_server, teardown_test_server
 
+# (apduType, header fields) of PDUs that Conpot must never answer
+NO_REPLY_SHAPES = (
+    # SimpleAckPDU - apduInvokeID and apduService
+    (2, {"apduService": 8}),
+    # ErrorPDU - apduInvokeID and apduService
+    (5, {"apduService": 8}),
+    # RejectPDU - apduInvokeID and apduAbortRejectReason
+    (6, {"apduAbortRejectReason": 9}),
+    # AbortPDU - apduInvokeID and apduAbortRejectReason
+    (7, {"apduAbortRejectReason": 9}),
+)
+
+
+def encode_pdu(apdu_request):
+    """encode a bacpypes request/response into the raw bytes sent on the wire"""
+    apdu = APDU()
+    apdu_request.encode(apdu)
+    pdu = PDU()
+    apdu.encode(pdu)
+    return pdu.pduData
+
+
+def encode_no_reply_pdu(apdu_type, attrs):
+    """encode a bare APDU of the given type and header fields, carrying some test data"""
+    apdu = APDU()
+    apdu.apduType = apdu_type
+    apdu.apduInvokeID = 101
+    for key, value in attrs.items():
+        setattr(apdu, key, value)
+    apdu.put_data(b"test_data")
+    pdu = PDU()
+    apdu.encode(pdu)
+    return bytes(pdu.pduData)
+
 
 class TestBACnetServer(unittest.TestCase):
 
@@ -48,71 +85,93 @@ class TestBACnetServer(unittest.TestCase):
     two encoded data.
     """
 
+    @classmethod
+    def setUpClass(cls):
+        # the expected replies only depend on the default template, encode them once
+        broadcast = GlobalBroadcast()
+        expected = IAmRequest()
+        expected.pduDestination = broadcast
+        expected.iAmDeviceIdentifier = 36113
+        expected.maxAPDULengthAccepted = 1024
+        expected.segmentationSupported = "segmentedBoth"
+        expected.vendorID = 15
+        cls.expected_i_am = encode_pdu(expected)
+
+        expected = IHaveRequest()
+        expected.pduDestination = broadcast
+        expected.deviceIdentifier = 36113
+        expected.objectIdentifier = 12
+        expected.objectName = "BI 01"
+        cls.expected_i_have = encode_pdu(expected)
+
+        expected = ReadPropertyACK()
+        expected.pduDestination = broadcast
+        expected.apduInvokeID = 101
+        expected.objectIdentifier = 14
+        expected.objectName = "AI 01"
+        expected.propertyIdentifier = 85
+        expected.propertyValue = Any(Real(68.0))
+        cls.expected_read_property_ack = encode_pdu(expected)
+
     def setUp(self):
         self.bacnet_server, self.greenlet = spawn_test_server(
             bacnet_server.BacnetServer, "default", "bacnet"
         )
 
         self.address = (self.bacnet_server.host, self.bacnet_server.port)
+        self.client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # talk to the test server only, so sends skip per-call address handling
+        self.client.connect(self.address)
 
     def tearDown(self):
+        self.client.close()
         teardown_test_server(self.bacnet_server, self.greenlet)
 
+    def drain_replies(self, timeout=0.05):
+        """collect every datagram that arrives until the client stays idle for timeout seconds"""
+        replies = []
+        while select.select([self.client], [], [], timeout)[0]:
+            replies.append(self.client.recv(1024))
+        return replies
+
     def test_whoIs(self):
         request = WhoIsRequest(
             deviceInstanceRangeLowLimit=500, deviceInstanceRangeHighLimit=50000
         )
-        apdu = APDU()
-        request.encode(apdu)
-        pdu = PDU()
-        apdu.encode(pdu)
-        buf_size = 1024
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        s.sendto(pdu.pduData, self.address)
-        data = s.recvfrom(buf_size)
-        s.close()
-        received_data = data[0]
+        self.client.send(encode_pdu(request))
+        received_data = self.client.recv(1024)
 
-        expected = IAmRequest()
-        expected.pduDestination = GlobalBroadcast()
-        expected.iAmDeviceIdentifier = 36113
-        expected.maxAPDULengthAccepted = 1024
-        expected.segmentationSupported = "segmentedBoth"
-        expected.vendorID = 15
-
-        exp_apdu = APDU()
-        expected.encode(exp_apdu)
-        exp_pdu = PDU()
-        exp_apdu.encode(exp_pdu)
+        self.assertEqual(self.expected_i_am, received_data)
 
-        self.assertEqual(exp_pdu.pduData, received_data)
+    def test_whoIs_out_of_range(self):
+        """When the device instance is outside the requested range, no I-Am should be returned"""
+        request = WhoIsRequest(
+            deviceInstanceRangeLowLimit=500, deviceInstanceRangeHighLimit=5000
+        )
+        self.client.send(encode_pdu(request))
+        self.assertEqual([], self.drain_replies())
 
     def test_whoHas(self):
         request_object = WhoHasObject()
         request_object.objectIdentifier = ("binaryInput", 12)
         request = WhoHasRequest(object=request_object)
-        apdu = APDU()
-        request.encode(apdu)
-        pdu = PDU()
-        apdu.encode(pdu)
-        buf_size = 1024
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        s.sendto(pdu.pduData, self.address)
-        data = s.recvfrom(buf_size)
-        s.close()
-        received_data = data[0]
+        self.client.send(encode_pdu(request))
+        received_data = self.client.recv(1024)
 
-        expected = IHaveRequest()
-        expected.pduDestination = GlobalBroadcast()
-        expected.deviceIdentifier = 36113
-        expected.objectIdentifier = 12
-        expected.objectName = "BI 01"
+        self.assertEqual(self.expected_i_have, received_data)
 
-        exp_apdu = APDU()
-        expected.encode(exp_apdu)
-        exp_pdu = PDU()
-        exp_apdu.encode(exp_pdu)
-        self.assertEqual(exp_pdu.pduData, received_data)
+    def test_whoHas_out_of_range(self):
+        """When the device instance is outside the requested limits, no I-Have should be returned"""
+        request_object = WhoHasObject()
+        request_object.objectIdentifier = ("binaryInput", 12)
+        request = WhoHasRequest(
+            limits=WhoHasLimits(
+                deviceInstanceRangeLowLimit=0, deviceInstanceRangeHighLimit=10
+            ),
+            object=request_object,
+        )
+        self.client.send(encode_pdu(request))
+        self.assertEqual([], self.drain_replies())
 
     def test_readProperty(self):
         request = ReadPropertyRequest(
@@ -120,69 +179,18 @@ class TestBACnetServer(unittest.TestCase):
         )
         request.apduMaxResp = 1024
         request.apduInvokeID = 101
-        apdu = APDU()
-        request.encode(apdu)
-        pdu = PDU()
-        apdu.encode(pdu)
-        buf_size = 1024
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        s.sendto(pdu.pduData, self.address)
-        data = s.recvfrom(buf_size)
-        s.close()
-        received_data = data[0]
+        self.client.send(encode_pdu(request))
+        received_data = self.client.recv(1024)
 
-        expected = ReadPropertyACK()
-        expected.pduDestination = GlobalBroadcast()
-        expected.apduInvokeID = 101
-        expected.objectIdentifier = 14
-        expected.objectName = "AI 01"
-        expected.propertyIdentifier = 85
-        expected.propertyValue = Any(Real(68.0))
-
-        exp_apdu = APDU()
-        expected.encode(exp_apdu)
-        exp_pdu = PDU()
-        exp_apdu.encode(exp_pdu)
-
-        self.assertEqual(exp_pdu.pduData, received_data)
+        self.assertEqual(self.expected_read_property_ack, received_data)
 
     def test_no_response_requests(self):
         """When the request has apduType not 0x01, no reply should be returned from Conpot"""
-        request = ReadPropertyRequest(
-            objectIdentifier=("analogInput", 14), propertyIdentifier=85
-        )
-        request.pduData = bytearray(b"test_data")
-        request.apduMaxResp = 1024
-        request.apduInvokeID = 101
-        # Build requests - Confirmed, simple ack pdu, complex ack pdu, error pdu - etc.
-        test_requests = list()
-
-        for i in range(2, 8):
-            if i not in {1, 3, 4}:
-                request.apduType = i
-                if i == 2:
-                    # when apdu.apduType is 2 - we have SimpleAckPDU
-                    # set the apduInvokeID and apduService
-                    request.apduService = 8
-                elif i == 5:
-                    # when apdu.apduType is 5 - we have ErrorPDU
-                    # set the apduInvokeID and apduService
-                    request.apduService = 8
-                elif i == 6:
-                    # when apdu.apduType is 6 - we have RejectPDU
-                    # set the apduInvokeID and apduAbortRejectReason
-                    request.apduAbortRejectReason = 9
-                else:
-                    # when apdu.apduType is 7 - we have AbortPDU
-                    # set the apduInvokeID and apduAbortRejectReason
-                    request.apduAbortRejectReason = 9
-
-                test_requests.append(request)
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-
-        buf_size = 1024
-        [s.sendto(i.pduData, self.address) for i in test_requests]
-        results = None
-        with Timeout(1, False):
-            results = [s.recvfrom(buf_size) for i in range(len(test_requests))]
-        self.assertIsNone(results)
+        # Build requests - simple ack pdu, error pdu, reject pdu and abort pdu
+        payloads = [
+            encode_no_reply_pdu(apdu_type, attrs)
+            for apdu_type, attrs in NO_REPLY_SHAPES
+        ]
+        for payload in payloads:
+            self.client.send(payload)
+        self.assertEqual([], self.drain_replies())